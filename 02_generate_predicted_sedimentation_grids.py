@@ -1,12 +1,22 @@
 
-# Try importing 'ptt' first. If that fails then try 'gplately.ptt' (GPlately now contains PlateTectonicTools).
+import concurrent.futures
+import math
+import multiprocessing
+import multiprocessing.util
+# The netCDF4 module is optional. It's needed if 'output_combined_grid_files' is True.
+# It's also used (if installed) to read the age and distance grids directly (instead of sampling them with GMT)
+# and to write the grid file of each time directly (instead of converting the grid to text for GMT).
 try:
-    from ptt.utils.call_system_command import call_system_command
+    import netCDF4
 except ImportError:
-    from gplately.ptt.utils.call_system_command import call_system_command
-import multiprocessing
+    netCDF4 = None
+import numpy as np
 import os
+import predict_sediment_thickness
+import predict_sedimentation_rate
+import sedimentation_polynomial
 import sys
+import threading
 
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 """ ---------- Part 2 of the prediciting-sediment-thickness workflow ----------
@@ -14,11 +24,15 @@ This script creates grids (netcdfs) of sediment thickness and sediment rate thro
 
 Requirements amd Inputs:
     - Python
-    - Python scripts (predict_sediment_thickness.py, predict sedimentation_rate.py) - should be in this directory
+    - Python modules (predict_sediment_thickness.py, predict sedimentation_rate.py, sedimentation_polynomial.py) - should be in this directory
     - GMT 5 (or later)
     - Files associated with a tectonic model, in particular, the agegrids
     - PlateTectonicTools
     - pyGPlates
+    - cupy (optional) - only needed if 'device' is 'cuda' (to use an NVIDIA GPU)
+    - netCDF4 (optional) - needed to output combined grid files (containing all times), and
+                           speeds up reading of age and distance grids (that are on the output grid)
+                           and writing of the grid files of each time
 
 To modify the sediment thickness relationship (e.g. for a new present-day agegrid or sediment thickness grid),
 you will need to relcalculate the polynomial coefficients, and enter them into this script.
@@ -30,10 +44,12 @@ can be entered into lines 215-222 (for sedimentation rate) and 278-284 (for sedi
 Outputs:
     - folder named 'sedimentation_output' (or desired name, if changed), with 
       subfolders of sediment thickness and sediment rate grids through time.
+    - optionally, a single (NetCDF4) grid file per subfolder containing the grids at all times.
 
 2020-02-25: Added comments, created folders within the script itself
 2022-08-26: Update parameters for GlobSed and latest agegrids. Modify dirs to be consistent with pt1
 2024-02:    Improved memory usage.
+2026-10:    Predict sedimentation in-process (instead of launching a Python subprocess per time).
 """
 
 # ------------------------------------------
@@ -50,6 +66,23 @@ Outputs:
 use_all_cpus = 4
 #use_all_cpus = True
 
+# Use MPI (instead of 'use_all_cpus') to distribute the times across processes.
+#
+# If True then run this script with an MPI launcher, eg, "mpiexec -n 16 python 02_generate_predicted_sedimentation_grids.py".
+# Each MPI process generates the grids for its share of the times (using a single CPU), and the combined grid files
+# (see 'output_combined_grid_files') are written in parallel by all processes.
+# This requires the mpi4py Python module (and, for combined grid files, netCDF4 built with parallel HDF5 support).
+use_mpi = False
+
+# The device to evaluate the sedimentation polynomial on.
+#
+# If 'cpu' then use the CPU(s).
+# If 'cuda' then use an NVIDIA GPU (this requires the CuPy Python module).
+# Note: Each CPU process (see 'use_all_cpus' and 'use_mpi') uses the GPU, so fewer CPUs may be needed when using 'cuda'.
+#       The ages and distances are single precision (float32), so the GPU evaluates the polynomial in single precision.
+device = 'cpu'
+#device = 'cuda'
+
 # Base output directory.
 output_base_dir = '.'
 
@@ -62,6 +95,23 @@ time_step = 1
 generate_sediment_thickness_grids = True
 generate_sedimentation_rate_grids = True
 
+# Whether to output a separate grid file for each time (eg, 'sed_thick_0.1d_100.0.nc').
+output_grid_files_per_time = True
+
+# Whether to also output a single (NetCDF4) grid file, for each of sediment thickness and sedimentation rate, containing all times.
+#
+# The grids are stored in a 3D variable 'z' with dimensions (time, lat, lon) and one compressed chunk per time.
+# This requires the netCDF4 Python module.
+output_combined_grid_files = False
+#output_combined_grid_files = True
+
+# Whether to store the combined grid files (see 'output_combined_grid_files') as 16-bit integers (instead of 32-bit floats).
+#
+# This halves their size. The grids are stored with a (CF convention) 'scale_factor' attribute that tools like xarray
+# and GMT use to automatically convert back to floating-point, with a precision of 0.5 metres for sediment thickness
+# (up to a maximum of about 16km) and 0.01 for sedimentation rate (up to a maximum of about 327).
+pack_combined_grid_files = False
+
 distance_grid_spacing = 0.1   # grid spacing of input distance grids
 grid_spacing = 0.1            # grid spacing of output sedimentation grids
 
@@ -88,69 +138,393 @@ age_grid_filenames_format = '/Users/nickywright/Data/Age/Muller2019-Young2019-Ca
 # check if the base output directory exists. If it doesn't, create it.
 if not os.path.exists(os.path.join(output_base_dir, sediment_output_sub_dir)):
     print('{} does not exist, creating now... '.format(os.path.join(output_base_dir, sediment_output_sub_dir)))
-    os.mkdir(os.path.join(output_base_dir, sediment_output_sub_dir))
+    # Note: 'exist_ok' in case another MPI process (see 'use_mpi') creates it at the same time.
+    os.makedirs(os.path.join(output_base_dir, sediment_output_sub_dir), exist_ok=True)
 
 
 # ----- 
-def generate_predicted_sedimentation_grid(
+# All the times to generate sedimentation grids for (generated once per process).
+#
+# Note: A 'range' is an immutable sequence, so it can be iterated over many times, its slices (the consecutive times of each task)
+#       are also ranges (that are tiny to send to worker processes) and 'times.index(time)' is calculated (not searched).
+times = range(min_time, max_time + 1, time_step)
+
+
+# ----- 
+# The input points on a uniform lon/lat grid (at 'grid_spacing').
+#
+# This is generated once per process (and re-used for all times) since it's the same for all times.
+_input_points_grid = None
+
+def get_input_points_grid():
+    global _input_points_grid
+    if _input_points_grid is None:
+        _input_points_grid = predict_sediment_thickness.generate_input_points_grid(grid_spacing)
+    return _input_points_grid
+
+
+def create_grid_coordinates(grid_file, num_grid_latitudes, num_grid_longitudes):
+    """ Create the 'lat' and 'lon' dimensions and coordinate variables (GMT gridline registration) in a netCDF4.Dataset."""
+    
+    grid_file.createDimension('lat', num_grid_latitudes)
+    grid_file.createDimension('lon', num_grid_longitudes)
+    
+    lat_variable = grid_file.createVariable('lat', 'f8', ('lat',))
+    lat_variable.long_name = 'latitude'
+    lat_variable.units = 'degrees_north'
+    lat_variable[:] = -90 + np.arange(num_grid_latitudes) * grid_spacing
+    
+    lon_variable = grid_file.createVariable('lon', 'f8', ('lon',))
+    lon_variable.long_name = 'longitude'
+    lon_variable.units = 'degrees_east'
+    lon_variable[:] = -180 + np.arange(num_grid_longitudes) * grid_spacing
+
+
+def create_combined_grid_file(combined_grid_filename, times, long_name, units, int16_scale_factor=None, mpi_comm=None):
+    """ Create a NetCDF4 file containing a (time, lat, lon) grid variable (to be filled in later, one time at a time).
+    
+    If 'int16_scale_factor' is specified then the grid is packed into 16-bit integers using that scale factor.
+    If 'mpi_comm' is specified then the file is created in parallel (collectively) by all MPI processes in 'mpi_comm'.
+    """
+    
+    # Same grid points as 'predict_sediment_thickness.generate_input_points_grid()' (GMT gridline registration).
+    num_grid_latitudes = int(math.floor(180.0 / grid_spacing)) + 1
+    num_grid_longitudes = int(math.floor(360.0 / grid_spacing)) + 1
+    
+    if mpi_comm is not None:
+        from mpi4py import MPI
+        combined_grid_file = netCDF4.Dataset(combined_grid_filename, 'w', format='NETCDF4', parallel=True, comm=mpi_comm, info=MPI.Info())
+    else:
+        combined_grid_file = netCDF4.Dataset(combined_grid_filename, 'w', format='NETCDF4')
+    
+    with combined_grid_file:
+        combined_grid_file.createDimension('time', len(times))
+        
+        time_variable = combined_grid_file.createVariable('time', 'f4', ('time',))
+        time_variable.long_name = 'reconstruction time'
+        time_variable.units = 'Ma'
+        time_variable[:] = list(times)
+        
+        create_grid_coordinates(combined_grid_file, num_grid_latitudes, num_grid_longitudes)
+        
+        # Each time is a separate (compressed) chunk, so that each time can be written (and read) independently.
+        #
+        # Note: Parallel HDF5 can only write compressed data collectively (ie, all MPI processes writing at the same time),
+        #       but each MPI process writes its times independently (and there are not always the same number of times per process).
+        #       So don't compress when writing in parallel.
+        if int16_scale_factor is not None:
+            grid_variable = combined_grid_file.createVariable(
+                    'z', 'i2', ('time', 'lat', 'lon'),
+                    zlib=(mpi_comm is None), complevel=1,
+                    chunksizes=(1, num_grid_latitudes, num_grid_longitudes),
+                    fill_value=np.int16(-32768))
+            # The netCDF4 module (and other readers) automatically unpack using these.
+            grid_variable.scale_factor = int16_scale_factor
+            grid_variable.add_offset = 0.0
+        else:
+            grid_variable = combined_grid_file.createVariable(
+                    'z', 'f4', ('time', 'lat', 'lon'),
+                    zlib=(mpi_comm is None), complevel=1,
+                    chunksizes=(1, num_grid_latitudes, num_grid_longitudes),
+                    fill_value=np.nan)
+        grid_variable.long_name = long_name
+        grid_variable.units = units
+
+
+# Lock to prevent more than one thread (in this process) using the netCDF library at the same time (it's not thread-safe).
+#
+# Each process reads the age and distance grids in a background thread (see 'generate_predicted_sedimentation_grids_for_times()')
+# while writing grid files in its main thread.
+_netcdf_lock = threading.Lock()
+
+# Lock to prevent more than one process writing to a combined grid file at the same time.
+# This is None when not using multiple processes.
+_combined_grid_file_lock = None
+
+# Combined grid files that have been opened for parallel writing by all MPI processes (when 'use_mpi' is True).
+# Maps combined grid filename to its open netCDF4.Dataset.
+_mpi_combined_grid_files = {}
+
+# The maximum number of (consecutive) times to accumulate in memory before writing them to a combined grid file (in a single write).
+#
+# This reduces the number of times each combined grid file is opened, written and closed.
+# Note: At 0.1 degree grid spacing each time uses about 26MB (per combined grid file).
+_max_combined_grid_times_per_write = 8
+
+
+def write_combined_grid_variable(grid_variable, time_index, grids):
+    
+    # If the grid is packed into 16-bit integers (see 'pack_combined_grid_files') then clamp to the
+    # range of (non-negative) values that can be represented (the most negative integer is reserved for no-data).
+    if grid_variable.dtype == np.int16:
+        np.clip(grids, 0.0, 32767 * grid_variable.scale_factor, out=grids)
+    
+    # Grid points with no data (NaN) are masked so they're written as the fill value.
+    # The netCDF4 module also packs the values (if they're 16-bit integers), so first replace NaNs
+    # (under the mask) with a valid number to avoid casting NaN to an integer.
+    no_data_mask = np.isnan(grids)
+    grids[no_data_mask] = 0.0
+    grid_variable[time_index : time_index + len(grids), :, :] = np.ma.masked_array(grids, no_data_mask)
+
+
+def write_combined_grid_file(combined_grid_filename, first_time, grids):
+    """ Write the (time, lat, lon) grids, at consecutive times starting at 'first_time', into the combined grid file."""
+    
+    time_index = times.index(first_time)
+    
+    # If the file is already open for parallel writing (by all MPI processes) then each process writes its times independently.
+    if combined_grid_filename in _mpi_combined_grid_files:
+        with _netcdf_lock:
+            write_combined_grid_variable(_mpi_combined_grid_files[combined_grid_filename].variables['z'], time_index, grids)
+        return
+    
+    if _combined_grid_file_lock is not None:
+        _combined_grid_file_lock.acquire()
+    try:
+        with _netcdf_lock, netCDF4.Dataset(combined_grid_filename, 'a') as combined_grid_file:
+            write_combined_grid_variable(combined_grid_file.variables['z'], time_index, grids)
+    finally:
+        if _combined_grid_file_lock is not None:
+            _combined_grid_file_lock.release()
+
+
+def write_grid_file(grid_filename, grid):
+    """ Write a (lat, lon) grid to a NetCDF4 grid file with the same layout as GMT (ie, 'lat', 'lon' and 'z' variables).
+    
+    This is much faster than GMT 'xyz2grd' (which needs each grid point converted to text).
+    """
+    
+    num_grid_latitudes, num_grid_longitudes = grid.shape
+    
+    with _netcdf_lock, netCDF4.Dataset(grid_filename, 'w', format='NETCDF4') as grid_file:
+        grid_file.Conventions = 'CF-1.7'
+        
+        create_grid_coordinates(grid_file, num_grid_latitudes, num_grid_longitudes)
+        
+        # Grid points with no data (NaN) are written as NaN (like GMT).
+        grid_variable = grid_file.createVariable('z', 'f4', ('lat', 'lon'), zlib=True, complevel=1, fill_value=np.nan)
+        grid_variable.long_name = 'z'
+        grid_variable[:] = grid
+
+
+def write_sedimentation_grids(
+        write_sediment_data,
+        input_point_indices,  # indices of the input points (see 'get_ages_and_distances()')
+        sedimentation,  # sedimentation (rate or thickness) at the input points
+        time,
+        output_filename_prefix_format,  # output filename prefix with a format field for the time
+        combined_grid):  # (lat, lon) grid to fill in (None if not writing to a combined grid file)
+    
+    input_points, num_grid_longitudes, num_grid_latitudes = get_input_points_grid()
+    
+    # The grid file of the current time is written directly with netCDF4 if it's installed (otherwise with GMT).
+    write_grid_file_with_netcdf4 = output_grid_files_per_time and netCDF4 is not None
+    
+    # Scatter the input points into a (lat, lon) grid.
+    # Grid points with no data (eg, outside the ocean basins) remain NaN.
+    if combined_grid is not None or write_grid_file_with_netcdf4:
+        # If writing a combined grid file (containing all times) then its grid (at the current time) is also used
+        # for the grid file of the current time (so the points are only scattered once).
+        if combined_grid is not None:
+            grid = combined_grid
+        else:
+            grid = np.full((num_grid_latitudes, num_grid_longitudes), np.nan, dtype=np.float32)
+        
+        # The input points are ordered by latitude then longitude, which matches the grid's (lat, lon) row-major order.
+        grid.reshape(-1)[input_point_indices] = sedimentation  # a view (since 'grid' is contiguous)
+    
+    # Write the grid file (".nc") for the current time.
+    if output_grid_files_per_time:
+        output_filename_prefix = output_filename_prefix_format.format(time)
+        if write_grid_file_with_netcdf4:
+            write_grid_file('{}.nc'.format(output_filename_prefix), grid)
+        else:
+            write_sediment_data(
+                    np.column_stack((input_points[input_point_indices], sedimentation)),
+                    output_filename_prefix,
+                    (grid_spacing, num_grid_longitudes, num_grid_latitudes))
+
+
+def read_grid_at_input_points(grid_filename):
+    """ Read a grid file directly (with netCDF4) if its grid points match the input points grid (see 'get_input_points_grid()').
+    
+    Returns a 1D (float32) array of grid values (NaN where there's no data) in the same order as the input points,
+    or None if the grid points don't match the input points (or the grid can't be read).
+    """
+    
+    _, num_grid_longitudes, num_grid_latitudes = get_input_points_grid()
+    
+    try:
+        with _netcdf_lock, netCDF4.Dataset(grid_filename, 'r') as grid_file:
+            grid_variable = grid_file.variables['z']
+            if grid_variable.shape != (num_grid_latitudes, num_grid_longitudes):
+                return None
+            
+            # The grid must use GMT gridline registration at our grid spacing (ie, grid points on the input points).
+            lat_dimension_name, lon_dimension_name = grid_variable.dimensions
+            grid_lats = grid_file.variables[lat_dimension_name][:]
+            grid_lons = grid_file.variables[lon_dimension_name][:]
+            if not (np.allclose(grid_lats, -90 + np.arange(num_grid_latitudes) * grid_spacing) and
+                    np.allclose(grid_lons, -180 + np.arange(num_grid_longitudes) * grid_spacing)):
+                return None
+            
+            # Read the entire grid in one read (rather than sampling each point).
+            # Note: Values outside the ocean basins can be masked (fill values), so convert them to NaN.
+            #       And keep the grid as float32 (like the grid files) to halve memory usage (and bandwidth).
+            grid = np.ma.filled(grid_variable[:].astype(np.float32), np.nan)
+    except (OSError, KeyError, ValueError):
+        return None
+    
+    # The input points are ordered by latitude then longitude, which matches the grid's (lat, lon) row-major order.
+    return grid.reshape(-1)
+
+
+def get_ages_and_distances(time):
+    """ Get the ages and distances (at 'time') at the input points (excluding points where either is NaN).
+    
+    Returns a 3-tuple of 1D arrays (input point indices, ages, distances) where the input point indices
+    index into the input points (see 'get_input_points_grid()'), and the ages and distances are float32.
+    """
+    
+    input_points, num_grid_longitudes, _ = get_input_points_grid()
+    
+    age_grid_filename = age_grid_filenames_format.format(time)
+    distance_grid_filename = distance_grid_filenames_format.format(time)
+    
+    # If the age and distance grids are on the same grid points as the input points then read them directly
+    # (bypassing GMT, which is much slower since it samples each input point and converts the results to/from text).
+    if netCDF4 is not None:
+        ages = read_grid_at_input_points(age_grid_filename)
+        if ages is not None:
+            distances = read_grid_at_input_points(distance_grid_filename)
+            if distances is not None:
+                # Exclude if either age or distance is NaN.
+                input_point_indices = np.flatnonzero(~(np.isnan(ages) | np.isnan(distances)))
+                return input_point_indices, ages[input_point_indices], distances[input_point_indices]
+    
+    # Otherwise sample the age and distance grids (at the input points) using GMT.
+    #
+    # Note: This is an empty 1D array if no points have both an age and a distance, so reshape to (0, 4) in that case.
+    lon_lat_age_distance_array = predict_sediment_thickness.get_ages_and_distances(
+            input_points,
+            age_grid_filename,
+            distance_grid_filename).reshape(-1, 4)
+    
+    # Convert each (lon, lat) back to the index of its input point.
+    grid_lat_indices = np.rint((lon_lat_age_distance_array[:, 1] + 90) / grid_spacing).astype(int)
+    grid_lon_indices = np.rint((lon_lat_age_distance_array[:, 0] + 180) / grid_spacing).astype(int)
+    input_point_indices = grid_lat_indices * num_grid_longitudes + grid_lon_indices
+    
+    # Use float32 ages and distances (like the grids read directly), eg, so the polynomial is evaluated in single precision on a GPU.
+    return (input_point_indices,
+            np.ascontiguousarray(lon_lat_age_distance_array[:, 2], dtype=np.float32),
+            np.ascontiguousarray(lon_lat_age_distance_array[:, 3], dtype=np.float32))
+
+
+def generate_predicted_sedimentation_grids(
         time,
-        predict_sedimentation_script,
-        scale_sedimentation_rate,
-        mean_age,
-        mean_distance,
-        variance_age,
-        variance_distance,
-        max_age,
-        max_distance,
-        age_distance_polynomial_coefficients,
-        output_file_basename_prefix):
-    
-    command_line = [
-            sys.executable,  # python
-            predict_sedimentation_script,
-            '-d',
-            distance_grid_filenames_format.format(time),
-            '-g',
-            age_grid_filenames_format.format(time),
-            '-i',
-            str(grid_spacing),
-            '-w',
-            '-m',
-            str(mean_age),
-            str(mean_distance),
-            '-v',
-            str(variance_age),
-            str(variance_distance),
-            '-x',
-            str(max_age),
-            str(max_distance),
-            '-f']
-    command_line.extend(str(coeff) for coeff in age_distance_polynomial_coefficients)
-    # Only sediment rate requires scaling (sediment thickness does not)...
-    if scale_sedimentation_rate is not None:
-        command_line.extend([
-                '-s',
-                str(scale_sedimentation_rate)])
-    
-    output_filename_prefix = '{}_{:.1f}'.format(output_file_basename_prefix, time)
-    command_line.extend([
-            '--',
-            output_filename_prefix])
-    
-    #print('Time:', time)
-    #print(command_line)
-
-    #print(' '.join(command_line))
-    
-    # Execute the command.
-    call_system_command(command_line)
-
-
-# Wraps around 'generate_predicted_sedimentation_grid()' so can be used by multiprocessing.Pool.map()
-# which requires a single-argument function.
-def generate_predicted_sedimentation_grid_parallel_pool_function(args):
+        ages_and_distances,  # (input point indices, ages, distances) at 'time' (see 'get_ages_and_distances()')
+        sedimentation_rate_params,  # None if not generating sedimentation rate grids
+        sediment_thickness_params,  # None if not generating sediment thickness grids
+        combined_grids):  # maps each combined grid filename to the (lat, lon) grid to fill in (at 'time')
+    
+    # Note: The age and distance grids are read only once (for both sedimentation rate and sediment thickness).
+    input_point_indices, ages, distances = ages_and_distances
+    
+    if sedimentation_rate_params is not None:
+        (sedimentation_rate_polynomial,
+            output_filename_prefix_format,
+            combined_grid_filename) = sedimentation_rate_params
+        
+        sedimentation_rate = sedimentation_rate_polynomial.predict(ages, distances)
+        
+        write_sedimentation_grids(
+                predict_sedimentation_rate.write_sediment_data,
+                input_point_indices,
+                sedimentation_rate,
+                time,
+                output_filename_prefix_format,
+                combined_grids.get(combined_grid_filename))
+    
+    if sediment_thickness_params is not None:
+        (sediment_thickness_polynomial,
+            output_filename_prefix_format,
+            combined_grid_filename) = sediment_thickness_params
+        
+        sediment_thickness = sediment_thickness_polynomial.predict(ages, distances)
+        
+        write_sedimentation_grids(
+                predict_sediment_thickness.write_sediment_data,
+                input_point_indices,
+                sediment_thickness,
+                time,
+                output_filename_prefix_format,
+                combined_grids.get(combined_grid_filename))
+
+
+def generate_predicted_sedimentation_grids_for_times(
+        times,  # consecutive times
+        sedimentation_rate_params,  # None if not generating sedimentation rate grids
+        sediment_thickness_params):  # None if not generating sediment thickness grids
+    
+    _, num_grid_longitudes, num_grid_latitudes = get_input_points_grid()
+    
+    combined_grid_filenames = [params[-1] for params in (sedimentation_rate_params, sediment_thickness_params)
+            if params is not None and params[-1] is not None]
+    
+    # Read the age and distance grids of the next time (in a background thread) while predicting the current time.
+    # This hides the latency of reading the grids (netCDF4 and GMT don't hold Python's global interpreter lock while reading).
+    with concurrent.futures.ThreadPoolExecutor(1) as read_executor:
+        next_ages_and_distances = None
+        
+        # Accumulate the grids of a batch of consecutive times (in memory) so that they can be written to each combined grid file in a single write.
+        for batch_start_index in range(0, len(times), _max_combined_grid_times_per_write):
+            batch_times = times[batch_start_index : batch_start_index + _max_combined_grid_times_per_write]
+            
+            batch_combined_grids = dict(
+                    (combined_grid_filename, np.full((len(batch_times), num_grid_latitudes, num_grid_longitudes), np.nan, dtype=np.float32))
+                    for combined_grid_filename in combined_grid_filenames)
+            
+            # Start reading the first time's grids of this batch (if not already read during the previous batch).
+            if next_ages_and_distances is None:
+                next_ages_and_distances = read_executor.submit(get_ages_and_distances, batch_times[0])
+            
+            for batch_time_index, time in enumerate(batch_times):
+                ages_and_distances = next_ages_and_distances.result()
+                next_ages_and_distances = None
+                
+                # Start reading the next time's grids.
+                #
+                # But if writing combined grid files then not beyond this batch, since they're written (in this thread) at the end of
+                # this batch and the read would just wait for those writes anyway (netCDF library calls are serialised by '_netcdf_lock').
+                next_time_index = batch_start_index + batch_time_index + 1
+                if next_time_index < len(times) and (batch_time_index + 1 < len(batch_times) or not combined_grid_filenames):
+                    next_ages_and_distances = read_executor.submit(get_ages_and_distances, times[next_time_index])
+                
+                generate_predicted_sedimentation_grids(
+                        time,
+                        ages_and_distances,
+                        sedimentation_rate_params,
+                        sediment_thickness_params,
+                        dict((combined_grid_filename, combined_grids[batch_time_index])
+                                for combined_grid_filename, combined_grids in batch_combined_grids.items()))
+            
+            for combined_grid_filename, combined_grids in batch_combined_grids.items():
+                write_combined_grid_file(combined_grid_filename, batch_times[0], combined_grids)
+
+
+# The sedimentation parameters (all arguments of 'generate_predicted_sedimentation_grids_for_times()' except 'times').
+#
+# These are the same for all times and so are passed to each pool worker process once (via the pool initializer)
+# rather than once per task.
+_sedimentation_params = None
+
+
+# Wraps around 'generate_predicted_sedimentation_grids_for_times()' so can be submitted to a concurrent.futures.ProcessPoolExecutor
+# which requires a single-argument function (the consecutive times of a task).
+def generate_predicted_sedimentation_grids_parallel_pool_function(times):
     try:
-        return generate_predicted_sedimentation_grid(*args)
+        return generate_predicted_sedimentation_grids_for_times(times, *_sedimentation_params)
     except KeyboardInterrupt:
         pass
 
@@ -158,7 +532,6 @@ def generate_predicted_sedimentation_grid_parallel_pool_function(args):
 def low_priority():
     """ Set the priority of the process to below-normal."""
 
-    import sys
     try:
         sys.getwindowsversion()
     except AttributeError:
@@ -180,10 +553,193 @@ def low_priority():
         os.nice(1)
 
 
+def _release_cpu_slot(cpu_slots, cpu_slot):
+    with cpu_slots.get_lock():
+        cpu_slots[cpu_slot] = 0
+
+
+def _pin_to_cpu(cpu_slots):
+    """ Pin this worker process to its own CPU (if supported by the operating system).
+    
+    'cpu_slots' is a shared array of in-use flags (one per pool worker). This worker process claims the first free slot
+    and releases it when it exits (so that a replacement worker process, see 'max_tasks_per_child', can claim it).
+    """
+    
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    
+    # Only pin if there's a CPU available for each worker process (otherwise some would share a CPU).
+    available_cpus = sorted(os.sched_getaffinity(0))
+    if len(available_cpus) < len(cpu_slots):
+        return
+    
+    with cpu_slots.get_lock():
+        try:
+            cpu_slot = list(cpu_slots).index(0)
+        except ValueError:
+            # No free slots (eg, a previous worker process terminated abnormally), so don't pin.
+            return
+        cpu_slots[cpu_slot] = 1
+    
+    multiprocessing.util.Finalize(None, _release_cpu_slot, args=(cpu_slots, cpu_slot), exitpriority=0)
+    
+    os.sched_setaffinity(0, {available_cpus[cpu_slot]})
+
+
+def _worker_init(sedimentation_params, combined_grid_file_lock, cpu_slots):
+    """ Initialise each pool worker process (once per process, rather than once per time)."""
+
+    low_priority()
+
+    _pin_to_cpu(cpu_slots)
+
+    global _sedimentation_params
+    _sedimentation_params = sedimentation_params
+
+    global _combined_grid_file_lock
+    _combined_grid_file_lock = combined_grid_file_lock
+
+    # Generate the input points grid once per worker process.
+    get_input_points_grid()
+
+
+def _resolve_cpus(use_all_cpus):
+    """ Return the number of CPUs to use (where 'use_all_cpus' is True or a positive integer)."""
+
+    # If 'use_all_cpus' is a bool (and therefore must be True) then use all available CPUs...
+    if isinstance(use_all_cpus, bool):
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    # else 'use_all_cpus' is a positive integer specifying the number of CPUs to use...
+    elif isinstance(use_all_cpus, int) and use_all_cpus > 0:
+        return use_all_cpus
+    else:
+        raise TypeError('use_all_cpus: {} is neither a bool nor a positive integer'.format(use_all_cpus))
+
+
+# The (approximate) number of times a worker process generates grids for before it's replaced by a new worker process.
+#
+# This bounds the memory growth of long-running worker processes (eg, netCDF/HDF5 caches and heap fragmentation)
+# so that memory usage returns to baseline. Restarting a worker is cheap (the Numba kernel is cached on disk).
+_max_times_per_worker_process = 16
+
+
+def _run_parallel(func, task_args_list, num_cpus, initializer, initargs, max_tasks_per_child=None):
+    """ Call 'func' with each task argument in 'task_args_list' across 'num_cpus' worker processes.
+
+    Each worker process is first initialised by calling 'initializer(*initargs)', and is replaced by a new
+    worker process after completing 'max_tasks_per_child' tasks (if specified).
+    Tasks can complete in any order.
+    """
+
+    # Use the 'spawn' start method (rather than 'fork' on Linux) so that each worker process starts lean
+    # (imports only what this script imports) instead of inheriting a copy of the main process.
+    # This also avoids forking a process that might have already started Numba's (parallel) threads.
+    pool_context = multiprocessing.get_context('spawn')
+
+    # Each worker process should only use a single thread (since there's already a worker process per CPU).
+    # Otherwise each worker process would create a thread per CPU (eg, for Numba, OpenMP or BLAS) and oversubscribe the CPUs.
+    #
+    # Note: The worker processes inherit our environment (and are spawned, so they import NumPy/Numba after it's set).
+    #       Variables already set (by the user) are not overridden.
+    for num_threads_environment_variable in ('NUMBA_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ.setdefault(num_threads_environment_variable, '1')
+
+    # Replacing worker processes (after 'max_tasks_per_child' tasks) requires Python 3.11 (or later).
+    executor_kwargs = {}
+    if max_tasks_per_child is not None and sys.version_info >= (3, 11):
+        executor_kwargs['max_tasks_per_child'] = max_tasks_per_child
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+            num_cpus,
+            mp_context=pool_context,
+            initializer=initializer,
+            initargs=initargs,
+            **executor_kwargs)
+    try:
+        task_futures = [executor.submit(func, task_args) for task_args in task_args_list]
+
+        # Raises the task's exception (if any) as soon as a task fails (rather than after all tasks are done).
+        for task_future in concurrent.futures.as_completed(task_futures):
+            task_future.result()
+    except KeyboardInterrupt:
+        # Note: 'finally' block below gets executed before returning.
+        pass
+    finally:
+        # Cancel any tasks that haven't started yet (eg, if interrupted or a task failed).
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _run_pool(times, sedimentation_params):
+    """ Generate predicted sedimentation grids for all times, using 'use_all_cpus' to determine the number of CPUs."""
+
+    if not use_all_cpus:
+        # Use a single CPU (otherwise Numba would evaluate the polynomial using all CPUs).
+        sedimentation_polynomial.set_num_threads(1)
+        generate_predicted_sedimentation_grids_for_times(times, *sedimentation_params)
+        return
+
+    num_cpus = _resolve_cpus(use_all_cpus)
+
+    # Give each task a batch of consecutive times (rather than one time per task) to reduce inter-process communication
+    # (and so that each task can write its times to the combined grid files in fewer writes),
+    # but still with enough tasks (four per CPU) that CPUs don't sit idle waiting for the last tasks.
+    num_times_per_task = max(1, math.ceil(len(times) / (4 * num_cpus)))
+    task_times_list = [times[task_start_index : task_start_index + num_times_per_task]
+            for task_start_index in range(0, len(times), num_times_per_task)]
+
+    # Note: The lock and CPU slots must be created with the same ('spawn') context as the pool (see '_run_parallel()').
+    pool_context = multiprocessing.get_context('spawn')
+    _run_parallel(
+            generate_predicted_sedimentation_grids_parallel_pool_function,
+            task_times_list,
+            num_cpus,
+            _worker_init,
+            (sedimentation_params,
+                pool_context.Lock(),
+                pool_context.Array('b', num_cpus)),  # CPU slots (one per worker process, to pin it to a CPU)
+            # Recycle worker processes after about '_max_times_per_worker_process' times (but at least one task)...
+            max(1, _max_times_per_worker_process // num_times_per_task))
+
+
+def _run_mpi(times, sedimentation_params, mpi_comm):
+    """ Generate predicted sedimentation grids for this MPI process's share of the times."""
+
+    # Each MPI process uses a single CPU (there's already an MPI process per CPU).
+    # Otherwise Numba would evaluate the polynomial using all CPUs in each MPI process (and oversubscribe the CPUs).
+    sedimentation_polynomial.set_num_threads(1)
+
+    combined_grid_filenames = [params[-1] for params in sedimentation_params if params is not None and params[-1] is not None]
+
+    # All MPI processes must open (and close) the combined grid files together (collectively).
+    from mpi4py import MPI
+    for combined_grid_filename in combined_grid_filenames:
+        _mpi_combined_grid_files[combined_grid_filename] = netCDF4.Dataset(combined_grid_filename, 'a', parallel=True, comm=mpi_comm, info=MPI.Info())
+
+    try:
+        # Each MPI process generates a block of consecutive times (so it can write them to the combined grid files in fewer writes).
+        num_times_per_process = math.ceil(len(times) / mpi_comm.Get_size())
+        process_start_index = mpi_comm.Get_rank() * num_times_per_process
+        generate_predicted_sedimentation_grids_for_times(
+                times[process_start_index : process_start_index + num_times_per_process],
+                *sedimentation_params)
+    finally:
+        for combined_grid_filename in combined_grid_filenames:
+            _mpi_combined_grid_files.pop(combined_grid_filename).close()
+
 
 if __name__ == '__main__':
 
-    times = range(min_time, max_time + 1, time_step)
+    if output_combined_grid_files and netCDF4 is None:
+        raise ImportError("'output_combined_grid_files' requires the netCDF4 module")
+
+    if use_mpi:
+        from mpi4py import MPI
+        mpi_comm = MPI.COMM_WORLD
+    else:
+        mpi_comm = None
 
     # Machine learning training parameters.
     # These come from the "sediment_rate_decomp" IPython notebook (using sklearn Python module).
@@ -206,7 +762,6 @@ if __name__ == '__main__':
     #     print('Polynomial feature names:', regressor_trained_no_river.named_steps['poly'].get_feature_names())
     #
     #
-    # predict_sedimentation_script = 'predict_sedimentation_rate.py'
     # scale_sedimentation_rate = 10.0  # Scale predicted rate (cm/Ky) to (m/My).
     # mean_age = 57.08516053
     # mean_distance = 2004.37249998
@@ -233,9 +788,10 @@ if __name__ == '__main__':
     if generate_sedimentation_rate_grids:
         
         # updated for GlobSed and TRUNK agegrids
-        predict_sedimentation_script = 'predict_sedimentation_rate.py'
         #scale_sedimentation_rate = 1.0  # Keep predicted rate in (cm/Ky).
+        #sedimentation_rate_units = 'cm/Ky'
         scale_sedimentation_rate = 10.0  # Scale predicted rate (cm/Ky) to (m/My).
+        sedimentation_rate_units = 'm/My'
         mean_age = 61.17716597
         mean_distance = 1835.10750592
         variance_age =  1934.78513885
@@ -252,67 +808,34 @@ if __name__ == '__main__':
         # check if the output dir exists. If not, create
         if not os.path.exists(output_dir):
             print('{} does not exist, creating now... '.format(output_dir))
-            os.mkdir(output_dir)
-
-        print('Generating predicted sedimentation rate grids...')
-
-        if use_all_cpus:
-        
-            # If 'use_all_cpus' is a bool (and therefore must be True) then use all available CPUs...
-            if isinstance(use_all_cpus, bool):
-                try:
-                    num_cpus = multiprocessing.cpu_count()
-                except NotImplementedError:
-                    num_cpus = 1
-            # else 'use_all_cpus' is a positive integer specifying the number of CPUs to use...
-            elif isinstance(use_all_cpus, int) and use_all_cpus > 0:
-                num_cpus = use_all_cpus
-            else:
-                raise TypeError('use_all_cpus: {} is neither a bool nor a positive integer'.format(use_all_cpus))
-            
-            try:
-                # Split the workload across the CPUs.
-                pool = multiprocessing.Pool(num_cpus, initializer=low_priority)
-                pool_map_async_result = pool.map_async(
-                        generate_predicted_sedimentation_grid_parallel_pool_function,
-                        (
-                            (
-                                time,
-                                predict_sedimentation_script,
-                                scale_sedimentation_rate,
-                                mean_age,
-                                mean_distance,
-                                variance_age,
-                                variance_distance,
-                                max_age,
-                                max_distance,
-                                age_distance_polynomial_coefficients,
-                                output_file_basename_prefix
-                            ) for time in times
-                        ),
-                        1) # chunksize
-
-                # Apparently if we use pool.map_async instead of pool.map and then get the results
-                # using a timeout, then we avoid a bug in Python where a keyboard interrupt does not work properly.
-                # See http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool
-                pool_map_async_result.get(999999)
-            except KeyboardInterrupt:
-                # Note: 'finally' block below gets executed before returning.
-                pass
-            finally:
-                pool.close()
-                pool.join()
-
+            os.makedirs(output_dir, exist_ok=True)
+
+        if output_combined_grid_files:
+            combined_grid_filename = '{}.nc'.format(output_file_basename_prefix)
+            create_combined_grid_file(
+                    combined_grid_filename, times,
+                    'sedimentation rate', sedimentation_rate_units,
+                    0.01 if pack_combined_grid_files else None,  # int16 precision
+                    mpi_comm)
         else:
-            for time in times:
-                generate_predicted_sedimentation_grid(
-                        time,
-                        predict_sedimentation_script, scale_sedimentation_rate,
-                        mean_age, mean_distance,
-                        variance_age, variance_distance,
-                        max_age, max_distance,
-                        age_distance_polynomial_coefficients,
-                        output_file_basename_prefix)
+            combined_grid_filename = None
+
+        # Precompute the polynomial's constants once (rather than each time it's evaluated).
+        sedimentation_rate_polynomial = sedimentation_polynomial.Polynomial(
+                mean_age, mean_distance,
+                math.sqrt(variance_age), math.sqrt(variance_distance),
+                age_distance_polynomial_coefficients,
+                max_age, max_distance,
+                scale_sedimentation_rate,
+                device)
+
+        sedimentation_rate_params = (
+                sedimentation_rate_polynomial,
+                # Format the prefix into the output filenames once (rather than for each time)...
+                '{}_{{:.1f}}'.format(output_file_basename_prefix),
+                combined_grid_filename)
+    else:
+        sedimentation_rate_params = None
     
     #
     # Predict sediment *thickness* results in "sediment_thick_v5.ipynb" from:
@@ -333,8 +856,6 @@ if __name__ == '__main__':
     if generate_sediment_thickness_grids:
         
         # updated for GlobSed and TRUNK agegrids (NW 20220826)
-        predict_sedimentation_script = 'predict_sediment_thickness.py'
-        scale_sedimentation_rate = None  # No scaling - we're predicting sediment thickness (not rate).
         mean_age =  61.18406823
         mean_distance = 1835.28118479
         variance_age = 1934.6999014
@@ -351,63 +872,45 @@ if __name__ == '__main__':
         # check if the output dir exists. If not, create
         if not os.path.exists(output_dir):
             print('{} does not exist, creating now... '.format(output_dir))
-            os.mkdir(output_dir)
-        print('Generating predicted sediment thickness grids...')
+            os.makedirs(output_dir, exist_ok=True)
+
+        if output_combined_grid_files:
+            combined_grid_filename = '{}.nc'.format(output_file_basename_prefix)
+            create_combined_grid_file(
+                    combined_grid_filename, times,
+                    'compacted sediment thickness', 'm',
+                    0.5 if pack_combined_grid_files else None,  # int16 precision (metres)
+                    mpi_comm)
+        else:
+            combined_grid_filename = None
+
+        # Precompute the polynomial's constants once (rather than each time it's evaluated).
+        sediment_thickness_polynomial = sedimentation_polynomial.Polynomial(
+                mean_age, mean_distance,
+                math.sqrt(variance_age), math.sqrt(variance_distance),
+                age_distance_polynomial_coefficients,
+                max_age, max_distance,
+                device=device)
+
+        sediment_thickness_params = (
+                sediment_thickness_polynomial,
+                # Format the prefix into the output filenames once (rather than for each time)...
+                '{}_{{:.1f}}'.format(output_file_basename_prefix),
+                combined_grid_filename)
+    else:
+        sediment_thickness_params = None
 
-        if use_all_cpus:
-
-            # If 'use_all_cpus' is a bool (and therefore must be True) then use all available CPUs...
-            if isinstance(use_all_cpus, bool):
-                try:
-                    num_cpus = multiprocessing.cpu_count()
-                except NotImplementedError:
-                    num_cpus = 1
-            # else 'use_all_cpus' is a positive integer specifying the number of CPUs to use...
-            elif isinstance(use_all_cpus, int) and use_all_cpus > 0:
-                num_cpus = use_all_cpus
-            else:
-                raise TypeError('use_all_cpus: {} is neither a bool nor a positive integer'.format(use_all_cpus))
-            
-            try:
-                # Split the workload across the CPUs.
-                pool = multiprocessing.Pool(num_cpus, initializer=low_priority)
-                pool_map_async_result = pool.map_async(
-                        generate_predicted_sedimentation_grid_parallel_pool_function,
-                        (
-                            (
-                                time,
-                                predict_sedimentation_script,
-                                scale_sedimentation_rate,
-                                mean_age,
-                                mean_distance,
-                                variance_age,
-                                variance_distance,
-                                max_age,
-                                max_distance,
-                                age_distance_polynomial_coefficients,
-                                output_file_basename_prefix
-                            ) for time in times
-                        ),
-                        1) # chunksize
-
-                # Apparently if we use pool.map_async instead of pool.map and then get the results
-                # using a timeout, then we avoid a bug in Python where a keyboard interrupt does not work properly.
-                # See http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool
-                pool_map_async_result.get(999999)
-            except KeyboardInterrupt:
-                # Note: 'finally' block below gets executed before returning.
-                pass
-            finally:
-                pool.close()
-                pool.join()
+    if generate_sedimentation_rate_grids and generate_sediment_thickness_grids:
+        print('Generating predicted sedimentation rate and sediment thickness grids...')
+    elif generate_sedimentation_rate_grids:
+        print('Generating predicted sedimentation rate grids...')
+    elif generate_sediment_thickness_grids:
+        print('Generating predicted sediment thickness grids...')
 
+    # Each time generates both the sedimentation rate and sediment thickness grids (if requested)
+    # so that the age and distance grids only need to be sampled once per time.
+    if generate_sedimentation_rate_grids or generate_sediment_thickness_grids:
+        if mpi_comm is not None:
+            _run_mpi(times, (sedimentation_rate_params, sediment_thickness_params), mpi_comm)
         else:
-            for time in times:
-                generate_predicted_sedimentation_grid(
-                        time,
-                        predict_sedimentation_script, scale_sedimentation_rate,
-                        mean_age, mean_distance,
-                        variance_age, variance_distance,
-                        max_age, max_distance,
-                        age_distance_polynomial_coefficients,
-                        output_file_basename_prefix)
+            _run_pool(times, (sedimentation_rate_params, sediment_thickness_params))
@@ -27,6 +27,7 @@ import argparse
 import math
 import numpy as np
 import os
+import sedimentation_polynomial
 # Try importing 'ptt' first. If that fails then try 'gplately.ptt' (GPlately now contains PlateTectonicTools).
 try:
     from ptt.utils.call_system_command import call_system_command
@@ -78,16 +79,10 @@ def generate_input_points_grid(grid_spacing_degrees):
     num_latitudes = int(math.floor(180.0 / grid_spacing_degrees)) + 1
     num_longitudes = int(math.floor(360.0 / grid_spacing_degrees)) + 1
 
-    input_points = np.full((num_latitudes * num_longitudes, 2), (0.0, 0.0), dtype=float)  # numpy array uses less memory
-    input_point_index = 0
-    for lat_index in range(num_latitudes):
-        lat = -90 + lat_index * grid_spacing_degrees
-        
-        for lon_index in range(num_longitudes):
-            lon = -180 + lon_index * grid_spacing_degrees
-            
-            input_points[input_point_index] = (lon, lat)
-            input_point_index += 1
+    # Points are ordered by latitude then longitude (ie, longitude varies fastest).
+    input_points = np.empty((num_latitudes * num_longitudes, 2), dtype=float)  # numpy array uses less memory
+    input_points[:, 0] = np.tile(-180 + np.arange(num_longitudes) * grid_spacing_degrees, num_latitudes)
+    input_points[:, 1] = np.repeat(-90 + np.arange(num_latitudes) * grid_spacing_degrees, num_longitudes)
     
     return (input_points, num_longitudes, num_latitudes)
 
@@ -176,28 +171,24 @@ def write_grd_file(grd_filename, output_data, grid_spacing, num_grid_longitudes,
 
 
 def predict_sedimentation_rate(
-        age,
-        distance,
+        ages,
+        distances,
         mean_age,
         mean_distance,
         std_deviation_age,
         std_deviation_distance,
-        age_distance_polynomial_coefficients):
-    
-    # We need to remove the mean and scale to unit variance (for the age and distance values)
-    # based on the machine learning training scaler.
-    # See http://scikit-learn.org/stable/modules/preprocessing.html#standardization-or-mean-removal-and-variance-scaling
-    age = (age - mean_age) / std_deviation_age
-    distance = (distance - mean_distance) / std_deviation_distance
-    
-    age_distance_polynomial_features = [
-            1, age, distance, age*age, age*distance, distance*distance, age*age*age, age*age*distance, age*distance*distance, distance*distance*distance]
-    
-    # Evaluate the polynomial to get the log of the predicated sedimentation rate.
-    log_sedimentation_rate = sum(age_distance_polynomial_coefficients[i] * age_distance_polynomial_features[i] for i in range(10))
+        age_distance_polynomial_coefficients,
+        max_age = None,
+        max_distance = None):
     
-    # Return the predicted sedimentation rate (not as a logarithm).
-    return math.exp(log_sedimentation_rate)
+    # Evaluate the polynomial (of standardised age and distance) over all the (numpy array) ages and distances at once
+    # to get the predicted sedimentation rate (not as a logarithm).
+    return sedimentation_polynomial.predict(
+            ages, distances,
+            mean_age, mean_distance,
+            std_deviation_age, std_deviation_distance,
+            age_distance_polynomial_coefficients,
+            max_age, max_distance)
 
 
 def predict_sedimentation(
@@ -220,7 +211,37 @@ def predict_sedimentation(
     """
     
     # Get the input point ages and mean distances to passive continental margins.
-    lon_lat_age_distance_array = get_ages_and_distances(input_points, age_grid_filename, distance_grid_filename, max_age, max_distance)
+    lon_lat_age_distance_array = get_ages_and_distances(input_points, age_grid_filename, distance_grid_filename)
+    
+    return predict_sedimentation_from_ages_and_distances(
+            lon_lat_age_distance_array,
+            mean_age,
+            mean_distance,
+            variance_age,
+            variance_distance,
+            age_distance_polynomial_coefficients,
+            max_age,
+            max_distance,
+            sedimentation_rate_scale)
+
+
+def predict_sedimentation_from_ages_and_distances(
+        lon_lat_age_distance_array, # Array of (lon, lat, age, distance) rows (eg, from 'get_ages_and_distances()').
+        mean_age,
+        mean_distance,
+        variance_age,
+        variance_distance,
+        age_distance_polynomial_coefficients,
+        max_age = None,
+        max_distance = None,
+        sedimentation_rate_scale = 1.0):
+    """
+    Same as 'predict_sedimentation()' except the ages and distances have already been sampled at the ocean basin points.
+    
+    This is useful when the same ages and distances are used for more than one prediction.
+    
+    Returns: A list containing 3-tuples of (lon, lat, sed_rate).
+    """
     
     #
     # Calculate mean/variance statistics on the age/distance data.
@@ -245,19 +266,27 @@ def predict_sedimentation(
     std_deviation_age = math.sqrt(variance_age)
     std_deviation_distance = math.sqrt(variance_distance)
     
+    if len(lon_lat_age_distance_array) == 0:
+        return np.empty((0, 3), dtype=float)
+    
+    ages = lon_lat_age_distance_array[:, 2]
+    distances = lon_lat_age_distance_array[:, 3]
+    
     # For each ocean basin point predict average sedimentation rate.
-    lon_lat_average_sedimentation_rate_array = np.full((len(lon_lat_age_distance_array), 3), (0.0, 0.0, 0.0), dtype=float)  # numpy array uses less memory
-    point_index = 0
-    for lon, lat, age, distance in lon_lat_age_distance_array:
-        
-        predicted_sedimentation_rate = sedimentation_rate_scale * predict_sedimentation_rate(
-                age, distance,
-                mean_age, mean_distance,
-                std_deviation_age, std_deviation_distance,
-                age_distance_polynomial_coefficients)
-        
-        lon_lat_average_sedimentation_rate_array[point_index] = (lon, lat, predicted_sedimentation_rate)
-        point_index += 1
+    #
+    # Note: This is vectorised (over all points at once) rather than looping over the points in Python.
+    predicted_sedimentation_rates = predict_sedimentation_rate(
+            ages, distances,
+            mean_age, mean_distance,
+            std_deviation_age, std_deviation_distance,
+            age_distance_polynomial_coefficients,
+            max_age, max_distance)  # clamp to max values if requested
+    predicted_sedimentation_rates *= sedimentation_rate_scale
+    
+    lon_lat_average_sedimentation_rate_array = np.column_stack((
+            lon_lat_age_distance_array[:, 0],  # lons
+            lon_lat_age_distance_array[:, 1],  # lats
+            predicted_sedimentation_rates))
     
     return lon_lat_average_sedimentation_rate_array
     
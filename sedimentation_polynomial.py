@@ -0,0 +1,285 @@
+
+"""
+    Copyright (C) 2026 The University of Sydney, Australia
+
+    This program is free software; you can redistribute it and/or modify it under
+    the terms of the GNU General Public License, version 2, as published by
+    the Free Software Foundation.
+
+    This program is distributed in the hope that it will be useful, but WITHOUT
+    ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+    FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+    for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+
+######################################################################################################
+# Evaluate the (machine learning trained) polynomial of ocean floor age and distance to passive     #
+# margins that predicts sedimentation (rate or thickness) at many ocean basin points at once.       #
+######################################################################################################
+
+
+
+import math
+import numpy as np
+# Numba is optional. If it's not installed then the polynomial is evaluated using NumPy (which is slower).
+try:
+    import numba
+except ImportError:
+    numba = None
+# CuPy is optional. It's only needed to evaluate the polynomial on an (NVIDIA) GPU (see the 'device' argument of 'Polynomial').
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+if numba is not None:
+
+    # Evaluate the polynomial (and its exponential) in a single parallel loop over the points.
+    #
+    # This avoids the temporary arrays (and the associated memory traffic) of the NumPy version.
+    #
+    # Note: We don't enable all 'fastmath' flags since 'nnan' and 'ninf' would assume there are no NaNs
+    #       (and the ages/distances can be NaN outside the ocean basins).
+    @numba.njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+    def _predict_numba(
+            ages,
+            distances,
+            predictions,
+            mean_age,
+            mean_distance,
+            inv_std_deviation_age,
+            inv_std_deviation_distance,
+            max_standardised_age,
+            max_standardised_distance,
+            c0, c1, c2, c3, c4, c5, c6, c7, c8, c9):
+
+        for i in numba.prange(ages.shape[0]):
+            age = (ages[i] - mean_age) * inv_std_deviation_age
+            distance = (distances[i] - mean_distance) * inv_std_deviation_distance
+
+            # Clamp to the max (standardised) values using selects (rather than branches) so the loop can be vectorised.
+            #
+            # Note: We don't use 'math.fmin()' since it returns the max value (rather than NaN) when the age/distance is NaN.
+            age = max_standardised_age if age > max_standardised_age else age
+            distance = max_standardised_distance if distance > max_standardised_distance else distance
+
+            predictions[i] = math.exp(
+                    c0 + age * (c1 + age * (c3 + c6*age + c7*distance) + distance * (c4 + c8*distance)) +
+                        distance * (c2 + distance * (c5 + c9*distance)))
+
+
+if cupy is not None:
+
+    # Evaluate the polynomial (and its exponential) in a single GPU kernel (same as '_predict_numba()').
+    #
+    # The type 'T' is the floating-point type of the ages and distances (eg, float32 is much faster than float64 on consumer GPUs).
+    _predict_cupy = cupy.ElementwiseKernel(
+            'T age, T distance, T mean_age, T mean_distance, T inv_std_deviation_age, T inv_std_deviation_distance, '
+                'T max_standardised_age, T max_standardised_distance, raw T c',
+            'T prediction',
+            '''
+            T a = (age - mean_age) * inv_std_deviation_age;
+            T d = (distance - mean_distance) * inv_std_deviation_distance;
+            // Clamp to the max (standardised) values (keeping NaNs).
+            a = a > max_standardised_age ? max_standardised_age : a;
+            d = d > max_standardised_distance ? max_standardised_distance : d;
+            prediction = exp(
+                    c[0] + a * (c[1] + a * (c[3] + c[6]*a + c[7]*d) + d * (c[4] + c[8]*d)) +
+                        d * (c[2] + d * (c[5] + c[9]*d)));
+            ''',
+            'sedimentation_polynomial')
+
+
+def set_num_threads(num_threads):
+    """
+    Set the number of CPU threads that the calling thread uses to evaluate the polynomial.
+
+    This only applies when Numba is used (NumPy evaluates the polynomial in a single thread).
+    """
+
+    if numba is not None:
+        numba.set_num_threads(num_threads)
+
+
+class Polynomial(object):
+    """
+    The degree-3 polynomial of (standardised) age and distance that predicts sedimentation (rate or thickness).
+
+    The constants used to evaluate the polynomial (such as the inverse standard deviations) are calculated once here
+    (rather than each time the polynomial is evaluated).
+
+    The ten polynomial coefficients correspond to the polynomial features:
+    constant, age, distance, age*age, age*distance, distance*distance,
+    age*age*age, age*age*distance, age*distance*distance and distance*distance*distance.
+
+    If 'scale' is specified then predictions are scaled by it (it must be positive, eg, a conversion of units).
+
+    The polynomial is evaluated on the 'device' which is either 'cpu' or 'cuda' (an NVIDIA GPU, which requires CuPy).
+    """
+
+    def __init__(
+            self,
+            mean_age,
+            mean_distance,
+            std_deviation_age,
+            std_deviation_distance,
+            age_distance_polynomial_coefficients,
+            max_age = None,
+            max_distance = None,
+            scale = 1.0,
+            device = 'cpu'):
+
+        if device == 'cuda':
+            if cupy is None:
+                raise ImportError("device 'cuda' requires the cupy module")
+        elif device != 'cpu':
+            raise ValueError("device: {} is neither 'cpu' nor 'cuda'".format(device))
+        self.device = device
+
+        self.mean_age = float(mean_age)
+        self.mean_distance = float(mean_distance)
+        self.inv_std_deviation_age = 1.0 / std_deviation_age
+        self.inv_std_deviation_distance = 1.0 / std_deviation_distance
+        # Clamping to the max values is done after standardisation (which preserves order since standard deviations are positive).
+        self.max_standardised_age = ((max_age - self.mean_age) * self.inv_std_deviation_age
+                if max_age is not None else math.inf)
+        self.max_standardised_distance = ((max_distance - self.mean_distance) * self.inv_std_deviation_distance
+                if max_distance is not None else math.inf)
+
+        self.coefficients = [float(coeff) for coeff in age_distance_polynomial_coefficients]
+        # Scaling the exponential is the same as adding the logarithm of the scale to the constant term.
+        if scale != 1.0:
+            self.coefficients[0] += math.log(scale)
+
+    def predict(self, ages, distances):
+        """
+        Evaluates the polynomial and returns its exponential
+        (since the polynomial was trained on the logarithm of sedimentation rate or thickness).
+
+        'ages' and 'distances' are numpy arrays (of the same shape). The returned array has the same shape and a floating-point
+        data type that can represent both (eg, float32 inputs are evaluated, and returned, as float32, and integer inputs
+        are returned as floating-point).
+
+        Ages and distances are first clamped to the max age and max distance (if specified).
+        NaN ages or distances result in NaN predictions.
+
+        On the 'cpu' device, Numba is used if it's installed, otherwise NumPy.
+        On the 'cuda' device, the ages and distances are copied to the GPU (and the predictions copied back).
+        """
+
+        ages = np.asarray(ages)
+        distances = np.asarray(distances)
+        # Note: The Numba and CuPy kernels don't check array bounds.
+        if ages.shape != distances.shape:
+            raise ValueError('ages shape {} does not match distances shape {}'.format(ages.shape, distances.shape))
+
+        # The predictions are floating-point (even if the ages and/or distances are integers).
+        dtype = np.result_type(ages, distances, np.float32)
+
+        if self.device == 'cuda':
+            predictions = _predict_cupy(
+                    cupy.asarray(np.ascontiguousarray(ages, dtype=dtype)),
+                    cupy.asarray(np.ascontiguousarray(distances, dtype=dtype)),
+                    dtype.type(self.mean_age),
+                    dtype.type(self.mean_distance),
+                    dtype.type(self.inv_std_deviation_age),
+                    dtype.type(self.inv_std_deviation_distance),
+                    dtype.type(self.max_standardised_age),
+                    dtype.type(self.max_standardised_distance),
+                    cupy.asarray(self.coefficients, dtype=dtype))
+            return cupy.asnumpy(predictions)
+
+        c0, c1, c2, c3, c4, c5, c6, c7, c8, c9 = self.coefficients
+
+        if numba is not None:
+            predictions = np.empty(ages.shape, dtype=dtype)
+            _predict_numba(
+                    ages.reshape(-1),
+                    distances.reshape(-1),
+                    predictions.reshape(-1),  # a view (since 'predictions' is contiguous)
+                    self.mean_age,
+                    self.mean_distance,
+                    self.inv_std_deviation_age,
+                    self.inv_std_deviation_distance,
+                    self.max_standardised_age,
+                    self.max_standardised_distance,
+                    c0, c1, c2, c3, c4, c5, c6, c7, c8, c9)
+            return predictions
+
+        # We need to remove the mean and scale to unit variance (for the age and distance values)
+        # based on the machine learning training scaler.
+        # See http://scikit-learn.org/stable/modules/preprocessing.html#standardization-or-mean-removal-and-variance-scaling
+        #
+        # Note: These are new arrays (so the caller's 'ages' and 'distances' are not modified).
+        age = np.subtract(ages, self.mean_age, dtype=dtype)
+        age *= self.inv_std_deviation_age
+        distance = np.subtract(distances, self.mean_distance, dtype=dtype)
+        distance *= self.inv_std_deviation_distance
+
+        # Clamp to the max (standardised) values, in-place (if there are any max values).
+        #
+        # Note: 'np.minimum()' propagates NaNs (unlike 'np.fmin()').
+        if self.max_standardised_age != math.inf:
+            np.minimum(age, self.max_standardised_age, out=age)
+        if self.max_standardised_distance != math.inf:
+            np.minimum(distance, self.max_standardised_distance, out=distance)
+
+        # Evaluate the polynomial in nested (Horner) form using two temporary arrays (and in-place operations)
+        # to avoid allocating a new array for each polynomial term:
+        #
+        #   c0 + age * (c1 + age * (c3 + c6*age + c7*distance) + distance * (c4 + c8*distance)) +
+        #        distance * (c2 + distance * (c5 + c9*distance))
+        #
+        log_sedimentation = np.multiply(age, c6)
+        tmp = np.multiply(distance, c7)
+        log_sedimentation += tmp
+        log_sedimentation += c3
+        log_sedimentation *= age
+        np.multiply(distance, c8, out=tmp)
+        tmp += c4
+        tmp *= distance
+        log_sedimentation += tmp
+        log_sedimentation += c1
+        log_sedimentation *= age
+
+        np.multiply(distance, c9, out=tmp)
+        tmp += c5
+        tmp *= distance
+        tmp += c2
+        tmp *= distance
+        log_sedimentation += tmp
+        log_sedimentation += c0
+
+        # Return the predicted sedimentation (not as a logarithm).
+        return np.exp(log_sedimentation, out=log_sedimentation)
+
+
+def predict(
+        ages,
+        distances,
+        mean_age,
+        mean_distance,
+        std_deviation_age,
+        std_deviation_distance,
+        age_distance_polynomial_coefficients,
+        max_age = None,
+        max_distance = None):
+    """
+    Evaluates the degree-3 polynomial of (standardised) age and distance, and returns its exponential
+    (since the polynomial was trained on the logarithm of sedimentation rate or thickness).
+
+    This is the same as 'Polynomial(...).predict(ages, distances)'.
+    When the same polynomial is evaluated many times it's better to create a 'Polynomial' once (and reuse it).
+    """
+
+    return Polynomial(
+            mean_age, mean_distance,
+            std_deviation_age, std_deviation_distance,
+            age_distance_polynomial_coefficients,
+            max_age, max_distance).predict(ages, distances)